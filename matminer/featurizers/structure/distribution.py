@@ -2,19 +2,624 @@ from __future__ import division, unicode_literals, print_function
 
 import math
 import itertools
-from operator import itemgetter
+import multiprocessing
+from functools import lru_cache
 
 import numpy as np
-from scipy.stats import gaussian_kde
+import pandas as pd
 from pymatgen.analysis.diffraction.xrd import XRDCalculator
 from pymatgen.analysis.local_env import ValenceIonicRadiusEvaluator
 from pymatgen.core.periodic_table import Specie, Element
 from pymatgen.symmetry.analyzer import SpacegroupAnalyzer
+from tqdm.auto import tqdm
 
 from matminer.featurizers.base import BaseFeaturizer
 
+try:
+    import numba
+except ImportError:
+    numba = None
 
-class RadialDistributionFunction(BaseFeaturizer):
+# Numerical tolerance on neighbor distances, as in pymatgen: pairs up to
+#  cutoff + tol apart are neighbors, and a site is not its own neighbor
+_NEIGHBOR_TOL = 1e-8
+
+
+def _image_shifts(lattice_matrix, cutoff):
+    """Get the lattice translations needed to find all neighbors within cutoff
+
+    Args:
+        lattice_matrix: (3x3 array) lattice vectors as rows.
+        cutoff: (float) neighbor cutoff distance.
+    Returns:
+        (Mx3 array of float) translations, in fractional coordinates, of all
+            periodic images that may hold a neighbor of a site in the cell.
+    """
+    # Distance between lattice planes is the inverse norm of the
+    #  reciprocal lattice vectors (columns of the inverse matrix)
+    inv_heights = np.linalg.norm(np.linalg.inv(lattice_matrix), axis=0)
+    # Fractional coordinate differences lie within (-1, 1), hence the +1
+    n_max = np.ceil(cutoff * inv_heights).astype(int) + 1
+    ranges = [np.arange(-n, n + 1) for n in n_max]
+    return np.array(list(itertools.product(*ranges)), dtype=np.float64)
+
+
+def _use_parallel_kernels():
+    """Check whether to use the multi-threaded numba kernels
+
+    Worker processes of a multiprocessing pool, such as those started by
+    BaseFeaturizer.featurize_many when n_jobs is not 1, already run in
+    parallel with each other. They use the serial kernels instead, so that
+    each worker does not start a thread per core of its own.
+    """
+    return not multiprocessing.current_process().daemon
+
+
+if numba is not None:
+    @numba.njit(cache=True)
+    def _pair_distance(cart_coords, cart_shifts, i, j, m):
+        """Distance from site i to image m of site j
+
+        Evaluated with the same operations, in the same order, as in
+        _all_neighbors_numpy so that both give identical distances.
+        """
+        d_sq = 0.0
+        for k in range(3):
+            delta = cart_coords[j, k] + cart_shifts[m, k] - cart_coords[i, k]
+            d_sq += delta * delta
+        return math.sqrt(d_sq)
+
+    @numba.njit(cache=True)
+    def _count_neighbors(cart_coords, cart_shifts, max_dist, i):
+        """Count the neighbors of site i"""
+        count = 0
+        for j in range(cart_coords.shape[0]):
+            for m in range(cart_shifts.shape[0]):
+                d = _pair_distance(cart_coords, cart_shifts, i, j, m)
+                if d <= max_dist and (i != j or d > _NEIGHBOR_TOL):
+                    count += 1
+        return count
+
+    @numba.njit(cache=True)
+    def _fill_neighbors(cart_coords, cart_shifts, max_dist, i, k,
+                        center_idx, neigh_idx, dist):
+        """Store the neighbors of site i in the output arrays, from
+        position k onwards"""
+        for j in range(cart_coords.shape[0]):
+            for m in range(cart_shifts.shape[0]):
+                d = _pair_distance(cart_coords, cart_shifts, i, j, m)
+                if d <= max_dist and (i != j or d > _NEIGHBOR_TOL):
+                    center_idx[k] = i
+                    neigh_idx[k] = j
+                    dist[k] = d
+                    k += 1
+
+    @numba.njit(cache=True)
+    def _neighbor_offsets(counts):
+        """Get the position of the neighbors of each site in the output
+        arrays, and allocate those arrays"""
+        offsets = np.zeros(counts.shape[0] + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(counts)
+        center_idx = np.empty(offsets[-1], dtype=np.int32)
+        neigh_idx = np.empty(offsets[-1], dtype=np.int32)
+        dist = np.empty(offsets[-1], dtype=np.float64)
+        return offsets, center_idx, neigh_idx, dist
+
+    @numba.njit(parallel=True, cache=True)
+    def _all_neighbors_numba(cart_coords, cart_shifts, cutoff):
+        """Find all neighbors within cutoff of each site with compiled loops
+
+        The neighbors are enumerated twice: once to count them, which sizes
+        the output arrays and the offset of each site within them, and
+        once to fill those arrays. Both passes run in parallel over sites.
+        """
+        n_sites = cart_coords.shape[0]
+        max_dist = cutoff + _NEIGHBOR_TOL
+        counts = np.zeros(n_sites, dtype=np.int64)
+        for i in numba.prange(n_sites):
+            counts[i] = _count_neighbors(cart_coords, cart_shifts, max_dist, i)
+        offsets, center_idx, neigh_idx, dist = _neighbor_offsets(counts)
+        for i in numba.prange(n_sites):
+            _fill_neighbors(cart_coords, cart_shifts, max_dist, i,
+                            offsets[i], center_idx, neigh_idx, dist)
+        return center_idx, neigh_idx, dist
+
+    @numba.njit(cache=True)
+    def _all_neighbors_numba_serial(cart_coords, cart_shifts, cutoff):
+        """Single-threaded version of _all_neighbors_numba"""
+        n_sites = cart_coords.shape[0]
+        max_dist = cutoff + _NEIGHBOR_TOL
+        counts = np.zeros(n_sites, dtype=np.int64)
+        for i in range(n_sites):
+            counts[i] = _count_neighbors(cart_coords, cart_shifts, max_dist, i)
+        offsets, center_idx, neigh_idx, dist = _neighbor_offsets(counts)
+        for i in range(n_sites):
+            _fill_neighbors(cart_coords, cart_shifts, max_dist, i,
+                            offsets[i], center_idx, neigh_idx, dist)
+        return center_idx, neigh_idx, dist
+
+
+def _all_neighbors_numpy(cart_coords, cart_shifts, cutoff):
+    """Find all neighbors within cutoff of each site with array operations
+
+    Same output as _all_neighbors_numba, used when numba is not installed.
+    """
+    n_sites = len(cart_coords)
+    counts = np.empty(n_sites, dtype=np.intp)
+    neigh_idx, dist = [], []
+    for i in range(n_sites):
+        # Displacement from site i to each image of every site
+        delta = cart_coords[:, None, :] + cart_shifts[None, :, :] \
+            - cart_coords[i]
+        d = np.sqrt(delta[..., 0] * delta[..., 0]
+                    + delta[..., 1] * delta[..., 1]
+                    + delta[..., 2] * delta[..., 2])
+        keep = d <= cutoff + _NEIGHBOR_TOL
+        keep[i] &= d[i] > _NEIGHBOR_TOL
+        j, _ = np.nonzero(keep)
+        counts[i] = len(j)
+        neigh_idx.append(j.astype(np.int32))
+        dist.append(d[keep])
+    # Pairs are grouped by center site, so the center indices follow
+    #  directly from the number of neighbors of each site
+    center_idx = np.repeat(np.arange(n_sites, dtype=np.int32), counts)
+    return center_idx, np.concatenate(neigh_idx), np.concatenate(dist)
+
+
+def _all_neighbors(s, cutoff):
+    """Get all pairs of sites within a cutoff distance in a periodic structure
+
+    Replaces Structure.get_all_neighbors, which creates a site object for
+    every neighbor, with a direct search over the periodic images of each
+    site. Uses compiled code if numba is installed.
+
+    The pairs are returned as separate, compact arrays rather than as a list
+    of tuples. The distances are kept in double precision, as distances in
+    crystals often fall exactly on the edge between two bins.
+
+    The result for the most recent structure and cutoff is cached, so that
+    featurizers applied one after another to the same structure (e.g., with
+    MultipleFeaturizer) only search for its neighbors once. The returned
+    arrays are shared with the cache, and are read-only.
+
+    Args:
+        s: (Structure) structure to be evaluated.
+        cutoff: (float) maximum distance between neighbors.
+    Returns:
+        center_idx - (array of int32) index of the center site of each pair
+        neigh_idx - (array of int32) index of the neighbor site of each pair
+        dist - (array of float64) distance between the sites of each pair
+    """
+    # Key the cache on the contents of the structure rather than the object,
+    #  so that structures modified in place are not served stale results
+    return _get_all_neighbors(s.lattice.matrix.tobytes(),
+                              np.asarray(s.frac_coords,
+                                         dtype=np.float64).tobytes(),
+                              float(cutoff))
+
+
+@lru_cache(maxsize=1)
+def _get_all_neighbors(lattice_key, coords_key, cutoff):
+    """Get all pairs of sites within a cutoff distance in a periodic structure
+
+    Args:
+        lattice_key: (bytes) lattice matrix as float64 values.
+        coords_key: (bytes) fractional coordinates of the sites as float64.
+        cutoff: (float) maximum distance between neighbors.
+    Returns:
+        Output of `_all_neighbors`
+    """
+    lattice_matrix = np.frombuffer(lattice_key, dtype=np.float64)\
+        .reshape(3, 3)
+    frac_coords = np.frombuffer(coords_key, dtype=np.float64).reshape(-1, 3)
+    cart_coords = np.dot(frac_coords % 1.0, lattice_matrix)
+    cart_shifts = np.dot(_image_shifts(lattice_matrix, cutoff),
+                         lattice_matrix)
+    if numba is not None and _use_parallel_kernels():
+        neighbors = _all_neighbors_numba(cart_coords, cart_shifts, cutoff)
+    elif numba is not None:
+        neighbors = _all_neighbors_numba_serial(cart_coords, cart_shifts,
+                                                cutoff)
+    else:
+        neighbors = _all_neighbors_numpy(cart_coords, cart_shifts, cutoff)
+    for array in neighbors:
+        array.flags.writeable = False
+    return neighbors
+
+
+def _bin_indices(distances, bin_size, nbins, truncate=False):
+    """Get the bin of each distance in a set of equal-width bins from zero
+
+    By default, the bins match those of np.histogram with the edges
+    `i * bin_size` for i in 0..nbins, as generated by np.arange: each bin
+    includes its lower edge, and the last bin also includes its upper edge.
+    The bin is first estimated by division and then checked against the
+    edges, so that distances lying exactly on an edge are binned as by
+    np.histogram. If `truncate` is True, the bin is `int(distance /
+    bin_size)` instead.
+
+    Args:
+        distances: (array of float) distances to be binned.
+        bin_size: (float) width of each bin.
+        nbins: (int) number of bins.
+        truncate: (bool) whether to bin by truncated division.
+    Returns:
+        (array of int) bin of each distance, -1 for distances outside the
+            bins.
+    """
+    idx = (distances / bin_size).astype(np.intp)
+    if truncate:
+        return np.where(idx < nbins, idx, -1)
+    idx = np.minimum(idx, nbins - 1)
+    below = distances < idx * bin_size
+    above = ~below & (idx < nbins - 1) & (distances >= (idx + 1) * bin_size)
+    idx = idx - below + above
+    inside = (distances >= 0) & (distances <= nbins * bin_size)
+    return np.where(inside, idx, -1)
+
+
+if numba is not None:
+    @numba.njit(cache=True)
+    def _bin_index(d, bin_size, nbins, truncate):
+        """Compiled, scalar version of _bin_indices"""
+        if truncate:
+            b = int(d / bin_size)
+            return b if b < nbins else -1
+        if d < 0.0 or d > nbins * bin_size:
+            return -1
+        b = min(int(d / bin_size), nbins - 1)
+        if d < b * bin_size:
+            b -= 1
+        elif b < nbins - 1 and d >= (b + 1) * bin_size:
+            b += 1
+        return b
+
+    @numba.njit(cache=True)
+    def _accumulate_histogram(hist, distances, weights, groups, start, end,
+                              bin_size, nbins, truncate, bin_scale,
+                              group_scale):
+        """Add distances[start:end] to the histograms, scaling each count
+        as it is accumulated"""
+        for k in range(start, end):
+            b = _bin_index(distances[k], bin_size, nbins, truncate)
+            if b >= 0:
+                g = groups[k]
+                hist[g, b] += weights[k] * bin_scale[b] * group_scale[g]
+
+    @numba.njit(parallel=True, cache=True)
+    def _uniform_histogram_numba(distances, weights, groups, n_groups,
+                                 bin_size, nbins, truncate, bin_scale,
+                                 group_scale, n_chunks):
+        """Compiled kernel for _uniform_histogram
+
+        The distances are split into `n_chunks` contiguous chunks, one per
+        thread, and each chunk is accumulated into its own private
+        histogram so that threads never write to the same memory. The
+        private histograms are summed once all chunks are done. Each count
+        is scaled as it is accumulated, so no separate normalization passes
+        are needed.
+        """
+        n_dist = distances.shape[0]
+        local_hist = np.zeros((n_chunks, n_groups, nbins))
+        for c in numba.prange(n_chunks):
+            _accumulate_histogram(local_hist[c], distances, weights, groups,
+                                  c * n_dist // n_chunks,
+                                  (c + 1) * n_dist // n_chunks, bin_size,
+                                  nbins, truncate, bin_scale, group_scale)
+        return local_hist.sum(axis=0)
+
+    @numba.njit(cache=True)
+    def _uniform_histogram_numba_serial(distances, weights, groups, n_groups,
+                                        bin_size, nbins, truncate, bin_scale,
+                                        group_scale):
+        """Single-threaded version of _uniform_histogram_numba"""
+        hist = np.zeros((n_groups, nbins))
+        _accumulate_histogram(hist, distances, weights, groups, 0,
+                              distances.shape[0], bin_size, nbins, truncate,
+                              bin_scale, group_scale)
+        return hist
+
+
+def _uniform_histogram(distances, bin_size, nbins, weights=None, groups=None,
+                       n_groups=1, bin_scale=None, group_scale=None,
+                       truncate=False):
+    """Histogram distances into equal-width bins starting at zero.
+
+    The bin of each distance is computed directly from its value, as
+    described in `_bin_indices`, which avoids the binary search over bin
+    edges performed by np.histogram. Uses a compiled kernel if numba is
+    installed, and np.bincount otherwise. Both assign every distance to the
+    same bin.
+
+    Args:
+        distances: (array of float) distances to be binned.
+        bin_size: (float) width of each bin.
+        nbins: (int) number of bins.
+        weights: (array of float) weight of each distance. If None, each
+            distance counts once.
+        groups: (array of int) if provided, index of the separate histogram
+            each distance is added to.
+        n_groups: (int) number of separate histograms. Only used if `groups`
+            is provided.
+        bin_scale: (array of float) factor multiplying each bin, e.g. to
+            normalize by the volume of the bin.
+        group_scale: (array of float) factor multiplying each histogram.
+            Only used if `groups` is provided.
+        truncate: (bool) bin by truncated division, see `_bin_indices`.
+    Returns:
+        (array of float) sum of the weights in each bin. Has shape
+            (n_groups, nbins) if `groups` is provided, (nbins,) otherwise.
+    """
+    distances = np.asarray(distances, dtype=np.float64)
+    if weights is None:
+        weights = np.ones(len(distances))
+    weights = np.asarray(weights, dtype=np.float64)
+    if groups is None:
+        hist_groups = np.zeros(len(distances), dtype=np.intp)
+        group_scale = None
+    else:
+        hist_groups = np.asarray(groups, dtype=np.intp)
+    if bin_scale is None:
+        bin_scale = np.ones(nbins)
+    if group_scale is None:
+        group_scale = np.ones(n_groups)
+
+    if numba is not None:
+        args = (distances, weights, hist_groups, n_groups, float(bin_size),
+                nbins, truncate, np.asarray(bin_scale, dtype=np.float64),
+                np.asarray(group_scale, dtype=np.float64))
+        if _use_parallel_kernels():
+            hist = _uniform_histogram_numba(*args, numba.get_num_threads())
+        else:
+            hist = _uniform_histogram_numba_serial(*args)
+    else:
+        idx = _bin_indices(distances, bin_size, nbins, truncate=truncate)
+        keep = idx >= 0
+        hist = np.bincount(hist_groups[keep] * nbins + idx[keep],
+                           weights=weights[keep], minlength=n_groups * nbins)
+        hist = hist.reshape(n_groups, nbins)
+        hist = hist * np.asarray(bin_scale) * np.asarray(group_scale)[:, None]
+    return hist if groups is not None else hist[0]
+
+
+if numba is not None:
+    @numba.njit(parallel=True, cache=True)
+    def _batch_histograms_numba(distances, groups, offsets, n_groups,
+                                bin_size, nbins, bin_scale, group_scale):
+        """Histogram the distances of many structures at once
+
+        The distances of all structures are stored in one flat array, with
+        those of structure i in distances[offsets[i]:offsets[i + 1]].
+        Each structure is handled by a single thread and written to its own
+        row of the output, so threads never write to the same memory.
+        Distances with a negative group are skipped.
+        """
+        n_structs = offsets.shape[0] - 1
+        hist = np.zeros((n_structs, n_groups, nbins))
+        for i in numba.prange(n_structs):
+            for k in range(offsets[i], offsets[i + 1]):
+                g = groups[k]
+                if g >= 0:
+                    b = _bin_index(distances[k], bin_size, nbins, False)
+                    if b >= 0:
+                        hist[i, g, b] += bin_scale[b] * group_scale[i, g]
+        return hist
+
+
+def _argument_tuples(entries):
+    """Get the arguments of featurize_many as one 1-tuple per entry
+
+    Follows BaseFeaturizer.featurize_many in telling entries that are
+    single inputs from rows of arguments, such as the 2D array passed by
+    featurize_dataframe.
+
+    Args:
+        entries: (list-like) entries passed to featurize_many.
+    Returns:
+        ([tuple]) arguments of each entry, or None if `entries` is not
+            list-like or an entry does not hold exactly one argument.
+    """
+    if isinstance(entries, pd.DataFrame):
+        entries = entries.values
+    elif not isinstance(entries, (tuple, list, np.ndarray, pd.Series)):
+        return None
+    elif isinstance(entries, pd.Series) or len(entries) == 0 or \
+            not isinstance(entries[0], (tuple, list, np.ndarray)):
+        return [(x,) for x in entries]
+    args = [tuple(x) for x in entries]
+    if any(len(x) != 1 for x in args):
+        return None
+    return args
+
+
+class _BatchedHistogramMixin(object):
+    """Featurize many structures with a single histogram kernel
+
+    Implements `featurize_many` for featurizers that provide:
+        - `_batch_inputs(s)`, returning the distances, histogram index and
+            scale of each histogram of structure `s`
+        - `_batch_bins()`, returning the bin size, number of bins, scale of
+            each bin and number of histograms
+        - `_batch_features(hist)`, converting the histograms of a structure
+            into its features
+
+    Must precede BaseFeaturizer in the bases of the featurizer.
+    """
+
+    # Number of bonds above which the pending structures are binned
+    _batch_max_pairs = 2 ** 22
+
+    def featurize_many(self, entries, ignore_errors=False, return_errors=False,
+                       pbar=True):
+        """Featurize a list of structures.
+
+        If numba is installed, the neighbor distances of the structures are
+        binned in batches by a parallel kernel that handles one structure per
+        thread. The kernel runs on up to `n_jobs` threads in place of the
+        multiprocessing pool of `BaseFeaturizer.featurize_many`, and
+        `chunksize` is not used. Otherwise, or if the entries do not each
+        hold a single structure, falls back to
+        `BaseFeaturizer.featurize_many`.
+        """
+        args = _argument_tuples(entries) if numba is not None else None
+        if args is None:
+            return super(_BatchedHistogramMixin, self).featurize_many(
+                entries, ignore_errors=ignore_errors,
+                return_errors=return_errors, pbar=pbar)
+
+        if return_errors and not ignore_errors:
+            raise ValueError("Please set ignore_errors to True to use"
+                             " return_errors.")
+        if pbar:
+            args = tqdm(args, desc=self.__class__.__name__)
+
+        # Compute the neighbor distances of each structure, and bin them
+        #  whenever enough bonds are pending, so that memory use does not
+        #  grow with the number of entries. Structures for which this fails
+        #  are passed through featurize_wrapper, so that errors are raised
+        #  or recorded as in BaseFeaturizer.featurize_many
+        output = []
+        pending, distances, groups, group_scales = [], [], [], []
+        n_pending_pairs = 0
+        for x in args:
+            try:
+                d, g, scale = self._batch_inputs(*x)
+            except Exception:
+                output.append(self.featurize_wrapper(
+                    x, ignore_errors=ignore_errors,
+                    return_errors=return_errors))
+                continue
+            pending.append(len(output))
+            output.append(None)
+            distances.append(d)
+            groups.append(g)
+            group_scales.append(scale)
+            n_pending_pairs += len(d)
+            if n_pending_pairs >= self._batch_max_pairs:
+                self._bin_batch(output, pending, distances, groups,
+                                group_scales, return_errors)
+                pending, distances, groups, group_scales = [], [], [], []
+                n_pending_pairs = 0
+        self._bin_batch(output, pending, distances, groups, group_scales,
+                        return_errors)
+        return output
+
+    def _bin_batch(self, output, pending, distances, groups, group_scales,
+                   return_errors):
+        """Bin the distances of a batch of structures and store their
+        features at the positions `pending` of `output`"""
+        if len(pending) == 0:
+            return
+        bin_size, nbins, bin_scale, n_groups = self._batch_bins()
+        offsets = np.zeros(len(distances) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(d) for d in distances])
+        n_threads = numba.get_num_threads()
+        numba.set_num_threads(
+            max(1, min(self.n_jobs, numba.config.NUMBA_NUM_THREADS)))
+        try:
+            hists = _batch_histograms_numba(
+                np.concatenate(distances), np.concatenate(groups), offsets,
+                n_groups, float(bin_size), nbins,
+                np.asarray(bin_scale, dtype=np.float64),
+                np.array(group_scales, dtype=np.float64))
+        finally:
+            numba.set_num_threads(n_threads)
+
+        for i, hist in zip(pending, hists):
+            features = self._batch_features(hist)
+            if return_errors:
+                features = list(features) + [float("nan")]
+            output[i] = features
+
+
+def _get_symbol(specie):
+    """Get the element symbol of a species, which may carry an oxidation state
+    """
+    if isinstance(specie, Element):
+        return specie.symbol
+    else:
+        return specie.element.symbol
+
+
+def _prdf_inputs(s, cutoff, elements, pairs):
+    """Get the bonds of a structure, labeled by pair of elements, for a PRDF
+
+    Args:
+        s: (Structure) structure to be evaluated.
+        cutoff: (float) maximum bond length.
+        elements: ([str]) symbols of the elements of the partial RDFs.
+        pairs: ([(int, int)]) index in `elements` of the center and neighbor
+            element of each partial RDF.
+    Returns:
+        dists - (array of float64) length of each bond
+        groups - (array of int32) index in `pairs` of the pair of elements
+            of each bond, -1 if that pair is not in `pairs`
+        inv_n_alpha - (array of float) inverse of the number of sites of
+            each element in the structure, 1 for absent elements
+    """
+    # Index the element of each site. Symbols are only looked up once per
+    #  distinct species, and sites of other elements are given the index
+    #  len(elements)
+    n_elems = len(elements)
+    elem_to_idx = dict((e, i) for i, e in enumerate(elements))
+    specie_codes = dict((sp, elem_to_idx.get(_get_symbol(sp), n_elems))
+                        for sp in s.composition.keys())
+    site_codes = np.fromiter(map(specie_codes.__getitem__, s.species),
+                             dtype=np.int32, count=s.num_sites)
+
+    # Label each bond using a table of pair indices over all elements
+    pair_table = np.full((n_elems + 1, n_elems + 1), -1, dtype=np.int32)
+    for p, (i, j) in enumerate(pairs):
+        pair_table[i, j] = p
+    center_idx, neigh_idx, dists = _all_neighbors(s, cutoff)
+    groups = pair_table[site_codes[center_idx], site_codes[neigh_idx]]
+
+    n_alpha = np.bincount(site_codes, minlength=n_elems + 1)[:n_elems]
+    return dists, groups, 1.0 / np.maximum(n_alpha, 1)
+
+
+@lru_cache(maxsize=32)
+def _rdf_bins(cutoff, bin_size):
+    """Get the bins of a radial distribution function
+
+    The bins depend only on the cutoff and bin size, so they are computed
+    once and shared by every structure featurized with those settings.
+
+    Args:
+        cutoff: (float) distance up to which the RDF is computed.
+        bin_size: (float) width of each bin.
+    Returns:
+        bin_edges - (array of float) edges of the bins
+        shell_volume - (array of float) volume of the spherical shell
+            spanned by each bin
+    """
+    bin_edges = np.arange(0, cutoff + bin_size, bin_size)
+    shell_volume = 4.0 / 3.0 * math.pi * (
+            np.power(bin_edges[1:], 3) - np.power(bin_edges[:-1], 3))
+    # The arrays are shared between calls, so guard them against changes
+    bin_edges.flags.writeable = False
+    shell_volume.flags.writeable = False
+    return bin_edges, shell_volume
+
+
+@lru_cache(maxsize=32)
+def _xrd_grid(two_theta_min, two_theta_max, pattern_length):
+    """Get the two theta values at which a smeared XRD pattern is evaluated
+
+    Args:
+        two_theta_min: (float) start of the two theta range, in degrees.
+        two_theta_max: (float) end of the two theta range, in degrees.
+        pattern_length: (int) number of points in the pattern.
+    Returns:
+        (array of float) evenly spaced two theta values
+    """
+    grid = np.linspace(two_theta_min, two_theta_max, pattern_length)
+    grid.flags.writeable = False
+    return grid
+
+
+class RadialDistributionFunction(_BatchedHistogramMixin,
+                                 BaseFeaturizer):
     """
     Calculate the radial distribution function (RDF) of a crystal structure.
 
@@ -45,21 +650,35 @@ class RadialDistributionFunction(BaseFeaturizer):
             raise ValueError("Disordered structure support not built yet")
 
         # Get the distances between all atoms
-        neighbors_lst = s.get_all_neighbors(self.cutoff)
-        all_distances = np.concatenate(
-            tuple(map(lambda x: [itemgetter(1)(e) for e in x], neighbors_lst)))
-
-        # Compute a histogram
-        dist_hist, dist_bins = np.histogram(
-            all_distances, bins=np.arange(
-                0, self.cutoff + self.bin_size, self.bin_size), density=False)
-
-        # Normalize counts
-        shell_vol = 4.0 / 3.0 * math.pi * (np.power(
-            dist_bins[1:], 3) - np.power(dist_bins[:-1], 3))
+        _, _, all_distances = _all_neighbors(s, self.cutoff)
+
+        # Compute a histogram, normalizing the counts as they are binned
+        dist_bins, shell_vol = _rdf_bins(self.cutoff, self.bin_size)
+        number_density = s.num_sites / s.volume
+        rdf = _uniform_histogram(all_distances, self.bin_size,
+                                 len(dist_bins) - 1,
+                                 bin_scale=1.0 / (shell_vol * number_density))
+        return [{'distances': dist_bins[:-1].copy(), 'distribution': rdf}]
+
+    def _batch_inputs(self, s):
+        """Get the distances and normalization of a structure for
+        `featurize_many`"""
+        if not s.is_ordered:
+            raise ValueError("Disordered structure support not built yet")
+        _, _, all_distances = _all_neighbors(s, self.cutoff)
+        groups = np.zeros(len(all_distances), dtype=np.int32)
         number_density = s.num_sites / s.volume
-        rdf = dist_hist / shell_vol / number_density
-        return [{'distances': dist_bins[:-1], 'distribution': rdf}]
+        return all_distances, groups, [1.0 / number_density]
+
+    def _batch_bins(self):
+        """Get the bins of the histograms computed in `featurize_many`"""
+        dist_bins, shell_vol = _rdf_bins(self.cutoff, self.bin_size)
+        return self.bin_size, len(dist_bins) - 1, 1.0 / shell_vol, 1
+
+    def _batch_features(self, hist):
+        """Convert the histogram computed in `featurize_many` to features"""
+        dist_bins = _rdf_bins(self.cutoff, self.bin_size)[0]
+        return [{'distances': dist_bins[:-1].copy(), 'distribution': hist[0]}]
 
     def feature_labels(self):
         return ["radial distribution function"]
@@ -71,7 +690,8 @@ class RadialDistributionFunction(BaseFeaturizer):
         return ["Saurabh Bajaj"]
 
 
-class PartialRadialDistributionFunction(BaseFeaturizer):
+class PartialRadialDistributionFunction(_BatchedHistogramMixin,
+                                        BaseFeaturizer):
     """
     Compute the partial radial distribution function (PRDF) of an xtal structure
 
@@ -162,6 +782,35 @@ class PartialRadialDistributionFunction(BaseFeaturizer):
         # Stack them together
         return np.hstack(output)
 
+    def _batch_inputs(self, s):
+        """Get the distances and normalization of a structure for
+        `featurize_many`
+
+        Each bond is assigned to the histogram of its pair of elements in
+        the feature vector. Bonds between pairs that are not part of the
+        features are given a group of -1, and are skipped.
+        """
+        if not s.is_ordered:
+            raise ValueError("Disordered structure support not built yet")
+        if self.elements_ is None:
+            raise Exception("You must run 'fit' first!")
+
+        pairs = list(itertools.combinations_with_replacement(
+            range(len(self.elements_)), 2))
+        dists, groups, inv_n_alpha = _prdf_inputs(s, self.cutoff,
+                                                  self.elements_, pairs)
+        return dists, groups, [inv_n_alpha[i] for i, _ in pairs]
+
+    def _batch_bins(self):
+        """Get the bins of the histograms computed in `featurize_many`"""
+        dist_bins, shell_volume = _rdf_bins(self.cutoff, self.bin_size)
+        n_pairs = len(self.elements_) * (len(self.elements_) + 1) // 2
+        return self.bin_size, len(dist_bins) - 1, 1.0 / shell_volume, n_pairs
+
+    def _batch_features(self, hist):
+        """Convert the histograms computed in `featurize_many` to features"""
+        return hist.ravel()
+
     def compute_prdf(self, s):
         """Compute the PRDF for a structure
 
@@ -173,49 +822,27 @@ class PartialRadialDistributionFunction(BaseFeaturizer):
                 and the value is the radial distribution function for
                 those paris of elements
         """
-        # Get the composition of the array
-        composition = s.composition.fractional_composition.to_reduced_dict
-
-        # Get the distances between all atoms
-        neighbors_lst = s.get_all_neighbors(self.cutoff)
-
-        # Sort neighbors by type
-        distances_by_type = {}
-        for p in itertools.product(composition.keys(), composition.keys()):
-            distances_by_type[p] = []
-
-        def get_symbol(site):
-            if isinstance(site.specie, Element):
-                return site.specie.symbol
-            else:
-                return site.specie.element.symbol
-
-        # Each list is a list for each site
-        for site, nlst in zip(s.sites, neighbors_lst):
-            my_elem = get_symbol(site)
-
-            for neighbor in nlst:
-                rij = neighbor[1]
-                n_elem = get_symbol(neighbor[0])
-                # LW 3May17: Any better ideas than appending each element at a time?
-                distances_by_type[(my_elem, n_elem)].append(rij)
-
-        # Compute and normalize the prdfs
+        # Label each bond by the pair of elements of its center and neighbor
+        elements = list(dict.fromkeys(_get_symbol(sp)
+                                      for sp in s.composition.keys()))
+        pairs = list(itertools.product(range(len(elements)), repeat=2))
+        dists, pair_ids, inv_n_alpha = _prdf_inputs(s, self.cutoff,
+                                                    elements, pairs)
+
+        # Compute the prdfs, normalizing the counts as they are binned
+        dist_bins, shell_volume = _rdf_bins(self.cutoff, self.bin_size)
+        rdfs = _uniform_histogram(dists, self.bin_size, len(dist_bins) - 1,
+                                  groups=pair_ids, n_groups=len(pairs),
+                                  bin_scale=1.0 / shell_volume,
+                                  group_scale=[inv_n_alpha[i]
+                                               for i, _ in pairs])
+
+        # Unpack the histograms by pair of element symbols
         prdf = {}
-        dist_bins = self._make_bins()
-        shell_volume = 4.0 / 3.0 * math.pi * (
-                np.power(dist_bins[1:], 3) - np.power(dist_bins[:-1], 3))
-        for key, distances in distances_by_type.items():
-            # Compute histogram of distances
-            dist_hist, dist_bins = np.histogram(distances, bins=dist_bins,
-                                                density=False)
-            # Normalize
-            n_alpha = composition[key[0]] * s.num_sites
-            rdf = dist_hist / shell_volume / n_alpha
-
-            prdf[key] = rdf
+        for rdf, (i, j) in zip(rdfs, pairs):
+            prdf[(elements[i], elements[j])] = rdf
 
-        return dist_bins[:-1], prdf
+        return dist_bins[:-1].copy(), prdf
 
     def _make_bins(self):
         """Generate the edges of the bins for the PRDF
@@ -223,20 +850,19 @@ class PartialRadialDistributionFunction(BaseFeaturizer):
         Returns:
             [list of float], edges of the bins
             """
-        return np.arange(0, self.cutoff + self.bin_size, self.bin_size)
+        return _rdf_bins(self.cutoff, self.bin_size)[0]
 
     def feature_labels(self):
         if self.elements_ is None:
             raise Exception("You must run 'fit' first!")
         bin_edges = self._make_bins()
-        labels = []
-        for e1, e2 in itertools.combinations_with_replacement(self.elements_,
-                                                              2):
-            for r_start, r_end in zip(bin_edges, bin_edges[1:]):
-                labels.append("{}-{} PRDF r={:.2f}-{:.2f}".format(
-                    e1, e2, r_start, r_end
-                ))
-        return labels
+        # Format the bin ranges once, as they are shared by all pairs
+        bin_ranges = [f"r={r_start:.2f}-{r_end:.2f}"
+                      for r_start, r_end in zip(bin_edges, bin_edges[1:])]
+        return [f"{e1}-{e2} PRDF {r}"
+                for e1, e2 in itertools.combinations_with_replacement(
+                    self.elements_, 2)
+                for r in bin_ranges]
 
     def citations(self):
         return ["@article{Schutt2014,"
@@ -310,18 +936,19 @@ class ElectronicRadialDistributionFunction(BaseFeaturizer):
                  np.linalg.norm(a - b + c), np.linalg.norm(a + b - c)])
 
         nbins = int(self.cutoff / self.dr) + 1
-        redf_dict = {"distances": np.array(
-            [(i + 0.5) * self.dr for i in range(nbins)]),
-            "distribution": np.zeros(nbins, dtype=np.float)}
-
-        for site in struct.sites:
-            this_charge = float(site.specie.oxi_state)
-            neighbors = struct.get_neighbors(site, self.cutoff)
-            for nnsite, dist, *_ in neighbors:
-                neigh_charge = float(nnsite.specie.oxi_state)
-                bin_index = int(dist / self.dr)
-                redf_dict["distribution"][bin_index] \
-                    += (this_charge * neigh_charge) / (struct.num_sites * dist)
+
+        # Get all pairs of neighboring sites
+        charges = np.fromiter((site.specie.oxi_state for site in struct.sites),
+                              dtype=np.float64, count=struct.num_sites)
+        center_idx, neigh_idx, dists = _all_neighbors(struct, self.cutoff)
+
+        # Weight each pair by its electrostatic interaction
+        weights = charges[center_idx] * charges[neigh_idx] / (
+                struct.num_sites * dists)
+        redf_dict = {"distances": (np.arange(nbins) + 0.5) * self.dr,
+                     "distribution": _uniform_histogram(
+                         dists, self.dr, nbins,
+                         weights=weights, truncate=True).astype(np.float64)}
 
         return [redf_dict]
 
@@ -343,7 +970,8 @@ class ElectronicRadialDistributionFunction(BaseFeaturizer):
 class XRDPowderPattern(BaseFeaturizer):
     """
     1D array representing powder diffraction of a structure as calculated by
-    pymatgen. The powder is smeared / normalized according to gaussian_kde.
+    pymatgen. The powder is smeared / normalized with a Gaussian kernel
+    density estimate.
 
     NOTE comprhys: placed in distribution as the rdf and ssf are related by
     a fourier transform.
@@ -359,12 +987,18 @@ class XRDPowderPattern(BaseFeaturizer):
                 two_thetas to calculate in degrees. Defaults to (0, 90). Set to
                 None if you want all diffracted beams within the limiting
                 sphere of radius 2 / wavelength.
-            bw_method (float): how much to smear the XRD pattern
+            bw_method (float or str): how much to smear the XRD pattern.
+                Either 'scott', 'silverman' or a scalar factor, as for
+                scipy.stats.gaussian_kde. None is the same as 'scott'.
             pattern_length (float): length of final array; defaults to one value
              per degree (i.e. two_theta_range + 1)
             **kwargs: any other arguments to pass into pymatgen's XRDCalculator,
                 such as the type of radiation.
         """
+        if not (bw_method is None or bw_method in ("scott", "silverman")
+                or isinstance(bw_method, (int, float, np.number))):
+            raise ValueError("bw_method must be 'scott', 'silverman' or a "
+                             "number, got {!r}".format(bw_method))
         self.two_theta_range = two_theta_range
         self.bw_method = bw_method
         self.pattern_length = pattern_length or two_theta_range[1] - \
@@ -374,19 +1008,39 @@ class XRDPowderPattern(BaseFeaturizer):
     def featurize(self, strc):
         pattern = self.xrd_calc.get_pattern(
             strc, two_theta_range=self.two_theta_range)
-        x, y = pattern.x, pattern.y
-        hist = []
-        for x1, y1 in zip(x, y):
-            num = int(y1)
-            hist += [x1] * num
-
-        kernel = gaussian_kde(hist, bw_method=self.bw_method)
-        x = np.linspace(self.two_theta_range[0], self.two_theta_range[1],
-                        self.pattern_length)
-        y = kernel(x)
+        # Smear each peak with a Gaussian kernel, weighting the peaks by
+        #  their truncated intensities. Equivalent to a gaussian_kde of the
+        #  peak positions repeated once per unit of intensity.
+        counts = pattern.y.astype(np.intp)
+        n_samples = counts.sum()
+        if n_samples < 2:
+            raise ValueError("The truncated intensities of the XRD pattern "
+                             "must sum to at least 2 to estimate its "
+                             "density, got {}".format(n_samples))
+        mean = np.dot(counts, pattern.x) / n_samples
+        variance = np.dot(counts, (pattern.x - mean) ** 2) / (n_samples - 1)
+        if variance == 0:
+            raise ValueError("The XRD pattern must have peaks at more than "
+                             "one two theta value to estimate its density")
+        sigma = self._bw_factor(n_samples) * np.sqrt(variance)
+
+        x = _xrd_grid(self.two_theta_range[0], self.two_theta_range[1],
+                      self.pattern_length)
+        diff = (x[:, None] - pattern.x[None, :]) / sigma
+        y = np.dot(np.exp(-0.5 * diff * diff), counts) / (
+                sigma * math.sqrt(2 * math.pi) * n_samples)
 
         return y
 
+    def _bw_factor(self, n_samples):
+        """Get the ratio of the kernel width to the standard deviation of the
+        peak positions, as computed by scipy.stats.gaussian_kde"""
+        if self.bw_method is None or self.bw_method == "scott":
+            return n_samples ** -0.2
+        elif self.bw_method == "silverman":
+            return (n_samples * 3 / 4) ** -0.2
+        return self.bw_method
+
     def feature_labels(self):
         return ['xrd_{}'.format(x) for x in range(self.pattern_length)]
 
@@ -6,17 +6,23 @@ from __future__ import unicode_literals, division
 import os
 import copy
 import unittest
+from unittest.mock import patch
 import csv
 import json
 import numpy as np
 import pandas as pd
 from multiprocessing import set_start_method
+from scipy.stats import gaussian_kde
 from sklearn.exceptions import NotFittedError
 
 from pymatgen import Structure, Lattice, Molecule
+from pymatgen.analysis.local_env import ValenceIonicRadiusEvaluator
+from pymatgen.symmetry.analyzer import SpacegroupAnalyzer
 from pymatgen.util.testing import PymatgenTest
 
+from matminer.featurizers.base import BaseFeaturizer
 from matminer.featurizers.composition import ElementProperty
+from matminer.featurizers.structure import distribution
 from matminer.featurizers.site import SiteElementalProperty
 from matminer.featurizers.structure import DensityFeatures, \
     RadialDistributionFunction, PartialRadialDistributionFunction, \
@@ -160,6 +166,17 @@ class StructureFeaturesTest(PymatgenTest):
         self.assertAlmostEqual(
             rdf['distribution'][int(round(7.0 / 0.5))], 1.805505363)
 
+        # Make sure featurize_many gives the same RDFs as featurize
+        featurizer = RadialDistributionFunction(cutoff=8, bin_size=0.5)
+        rdfs = featurizer.featurize_many([self.cscl, self.nacl], pbar=False)
+        self.assertEqual(len(rdfs), 2)
+        self.assertArrayAlmostEqual(
+            rdfs[0][0]['distribution'],
+            featurizer.featurize(self.cscl)[0]['distribution'])
+        self.assertArrayAlmostEqual(
+            rdfs[1][0]['distribution'],
+            featurizer.featurize(self.nacl)[0]['distribution'])
+
     def test_prdf(self):
         # Test a few peaks in diamond
         # These expected numbers were derived by performing
@@ -236,6 +253,155 @@ class StructureFeaturesTest(PymatgenTest):
         self.assertArrayAlmostEqual(features, np.hstack(
             [prdf[('Al', 'Al')], prdf[('Al', 'Ni')], prdf[('Ni', 'Ni')]]))
 
+        # Make sure featurize_many gives the same features as featurize
+        features = featurizer.featurize_many([self.ni3al, self.cscl],
+                                             pbar=False)
+        self.assertArrayAlmostEqual(features[0],
+                                    featurizer.featurize(self.ni3al))
+        self.assertArrayAlmostEqual(features[1],
+                                    featurizer.featurize(self.cscl))
+
+        # Make sure errors are handled as in BaseFeaturizer.featurize_many
+        disordered = Structure(Lattice.cubic(3.52),
+                               [{"Ni": 0.5, "Al": 0.5}], [[0, 0, 0]])
+        entries = [self.ni3al, disordered, self.cscl]
+        featurizer.set_n_jobs(1)
+        features = featurizer.featurize_many(
+            entries, ignore_errors=True, return_errors=True, pbar=False)
+        expected = BaseFeaturizer.featurize_many(
+            featurizer, entries, ignore_errors=True, return_errors=True,
+            pbar=False)
+        self.assertEqual(len(expected), len(features))
+        for row, expected_row in zip(features, expected):
+            self.assertEqual(len(expected_row), len(row))
+            self.assertArrayAlmostEqual(np.array(row[:-1], dtype=float),
+                                        np.array(expected_row[:-1],
+                                                 dtype=float))
+        self.assertTrue(np.isnan(features[0][-1]))
+        self.assertIn("Disordered structure", features[1][-1])
+        self.assertTrue(np.isnan(features[2][-1]))
+
+        # Binning the structures one batch at a time gives the same features
+        with patch.object(featurizer, "_batch_max_pairs", 1):
+            batched = featurizer.featurize_many(
+                entries, ignore_errors=True, return_errors=True, pbar=False)
+        self.assertEqual(len(features), len(batched))
+        for row, batched_row in zip(features, batched):
+            self.assertArrayAlmostEqual(np.array(row[:-1], dtype=float),
+                                        np.array(batched_row[:-1],
+                                                 dtype=float))
+
+        # Make sure featurize_dataframe, which passes rows of a 2D array,
+        #  gives the same features and is batched if numba is installed
+        df = pd.DataFrame({"structure": [self.ni3al, self.cscl]})
+        if distribution.numba is not None:
+            with patch.object(BaseFeaturizer, "featurize_many",
+                              side_effect=AssertionError("not batched")):
+                df = featurizer.featurize_dataframe(df, "structure",
+                                                    pbar=False)
+        else:
+            df = featurizer.featurize_dataframe(df, "structure", pbar=False)
+        labels = featurizer.feature_labels()
+        self.assertArrayAlmostEqual(df[labels].values[0],
+                                    featurizer.featurize(self.ni3al))
+        self.assertArrayAlmostEqual(df[labels].values[1],
+                                    featurizer.featurize(self.cscl))
+
+    def test_rdf_backends(self):
+        # Compare the RDF featurizers against np.histogram, with each
+        #  histogram backend. The cubic cells have lattice constants that are
+        #  multiples of the bin size, so many distances fall exactly on bin
+        #  edges
+        def cubic(a, species, coords):
+            return Structure.from_spacegroup("Fm-3m", Lattice.cubic(a),
+                                             species, coords)
+
+        simple_cubic = Structure(Lattice.cubic(4.2), ["Po"], [[0, 0, 0]])
+        edge_cubic = Structure(Lattice.cubic(2.9), ["Po"], [[0, 0, 0]])
+        mgo = cubic(4.2, ["Mg2+", "O2-"], [[0, 0, 0], [0.5, 0.5, 0.5]])
+        nacl = cubic(5.6, ["Na1+", "Cl1-"], [[0, 0, 0], [0.5, 0.5, 0.5]])
+        cutoff, bin_size = 10, 0.1
+        bins = np.arange(0, cutoff + bin_size, bin_size)
+        shell_vol = 4.0 / 3.0 * np.pi * (bins[1:] ** 3 - bins[:-1] ** 3)
+
+        def neighbors(s, r):
+            # Neighbor search without numba. Its distances match those of
+            #  pymatgen up to rounding, which can move a distance lying on
+            #  a bin edge, so the references are binned from them instead
+            distribution._get_all_neighbors.cache_clear()
+            with patch.object(distribution, "numba", None):
+                center, neigh, dists = distribution._all_neighbors(s, r)
+            pmg_dists = [n[1] for nlst in s.get_all_neighbors(r)
+                         for n in nlst]
+            self.assertArrayAlmostEqual(np.sort(dists), np.sort(pmg_dists),
+                                        decimal=10)
+            return center, neigh, dists
+
+        def symbol(site):
+            return getattr(site.specie, "element", site.specie).symbol
+
+        def reference_rdf(s):
+            _, _, dists = neighbors(s, cutoff)
+            return np.histogram(dists, bins=bins)[0] / shell_vol \
+                / (s.num_sites / s.volume)
+
+        def reference_prdf(s):
+            prdf = {}
+            for i, j, d in zip(*neighbors(s, cutoff)):
+                key = (symbol(s[i]), symbol(s[j]))
+                prdf.setdefault(key, []).append(d)
+            counts = s.composition.element_composition
+            return dict((key, np.histogram(d, bins=bins)[0] / shell_vol
+                         / counts[key[0]]) for key, d in prdf.items())
+
+        def reference_redf(s):
+            struct = SpacegroupAnalyzer(s).find_primitive() or s
+            struct = ValenceIonicRadiusEvaluator(struct).structure
+            a, b, c = struct.lattice.matrix
+            redf_cutoff = max(
+                [np.linalg.norm(a + b + c), np.linalg.norm(-a + b + c),
+                 np.linalg.norm(a - b + c), np.linalg.norm(a + b - c)])
+            nbins = int(redf_cutoff / 0.05) + 1
+            redf = np.zeros(nbins)
+            for i, j, d in zip(*neighbors(struct, redf_cutoff)):
+                redf[int(d / 0.05)] += \
+                    float(struct[i].specie.oxi_state) * \
+                    float(struct[j].specie.oxi_state) / \
+                    (struct.num_sites * d)
+            return redf
+
+        structures = [simple_cubic, edge_cubic, mgo, nacl]
+        references = [(reference_rdf(s), reference_prdf(s)) for s in
+                      structures]
+        redf_references = [reference_redf(s) for s in [mgo, nacl]]
+
+        backends = [{"numba": None}]
+        if distribution.numba is not None:
+            backends.append({"numba": distribution.numba})
+            # Serial kernels, as used in the workers of featurize_many
+            backends.append({"numba": distribution.numba,
+                             "_use_parallel_kernels": lambda: False})
+
+        for backend in backends:
+            distribution._get_all_neighbors.cache_clear()
+            with patch.multiple(distribution, **backend):
+                for s, (ref_rdf, ref_prdf) in zip(structures, references):
+                    rdf = RadialDistributionFunction(
+                        cutoff=cutoff, bin_size=bin_size).featurize(s)[0]
+                    self.assertArrayAlmostEqual(rdf["distribution"], ref_rdf)
+
+                    _, prdf = PartialRadialDistributionFunction(
+                        cutoff=cutoff, bin_size=bin_size).compute_prdf(s)
+                    self.assertEqual(set(prdf), set(ref_prdf))
+                    for key, ref in ref_prdf.items():
+                        self.assertArrayAlmostEqual(prdf[key], ref)
+
+                for s, ref in zip([mgo, nacl], redf_references):
+                    redf = ElectronicRadialDistributionFunction() \
+                        .featurize(s)[0]
+                    self.assertArrayAlmostEqual(redf["distribution"], ref)
+        distribution._get_all_neighbors.cache_clear()
+
     def test_redf(self):
         d = ElectronicRadialDistributionFunction().featurize(
             self.diamond)[0]
@@ -650,6 +816,24 @@ class StructureFeaturesTest(PymatgenTest):
         self.assertEqual(len(pattern), 91)
         self.assertEqual(len(xpp.feature_labels()), 91)
 
+        # bandwidth rules, compared with gaussian_kde
+        xrd = xpp.xrd_calc.get_pattern(self.diamond, two_theta_range=(0, 90))
+        samples = np.repeat(xrd.x, xrd.y.astype(int))
+        for bw_method in ["scott", "silverman", 0.1]:
+            xpp = XRDPowderPattern(two_theta_range=(0, 90),
+                                   bw_method=bw_method)
+            kde = gaussian_kde(samples, bw_method=bw_method)
+            self.assertArrayAlmostEqual(xpp.featurize(self.diamond),
+                                        kde(np.linspace(0, 90, 91)))
+
+        # invalid bandwidths and patterns without enough peaks
+        self.assertRaises(ValueError, XRDPowderPattern,
+                          bw_method=lambda kde: 0.1)
+        self.assertRaises(ValueError, XRDPowderPattern, bw_method="normal")
+        self.assertRaises(ValueError,
+                          XRDPowderPattern(two_theta_range=(0, 5)).featurize,
+                          self.diamond)
+
     @unittest.skipIf(not (torch and cgcnn),
                      "pytorch or cgcnn not installed.")
     def test_cgcnn_featurizer(self):